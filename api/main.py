@@ -1,4 +1,5 @@
 from flask import Flask
+import atexit
 import logging
 import tempfile
 import os
@@ -6,25 +7,34 @@ import shutil
 
 from api.routes.deployment import register_routes
 
-app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Use system temp directory for all work
-WORKDIR = tempfile.mkdtemp(prefix="k8s-deploy-")
+def cleanup_workdir(workdir):
+    """Remove the temporary working directory"""
+    if os.path.exists(workdir):
+        logger.info(f"Cleaning up temporary directory: {workdir}")
+        shutil.rmtree(workdir)
+
+# Created on the first create_app() call and shared by later ones
+WORKDIR = None
 
 def create_app():
+    global WORKDIR
+    app = Flask(__name__)
+    
+    # Use system temp directory for all work. Created here rather than at import
+    # so each server process gets its own directory and cleans it up on exit
+    if not WORKDIR:
+        WORKDIR = tempfile.mkdtemp(prefix="k8s-deploy-")
+        logger.info(f"Using temporary directory: {WORKDIR}")
+        logger.info("This directory will be automatically cleaned up when the service exits")
+        atexit.register(cleanup_workdir, WORKDIR)
+    
     register_routes(app, WORKDIR)
     return app
 
 if __name__ == '__main__':
-    logger.info(f"Using temporary directory: {WORKDIR}")
-    logger.info("This directory will be automatically cleaned up when the service exits")
-    try:
-        app = create_app()
-        app.run(host='0.0.0.0', port=5002, debug=True)
-    finally:
-        # Clean up temp directory when service exits
-        if os.path.exists(WORKDIR):
-            logger.info(f"Cleaning up temporary directory: {WORKDIR}")
-            shutil.rmtree(WORKDIR)
\ No newline at end of file
+    # Local development only, see README for running under gunicorn
+    app = create_app()
+    app.run(host='0.0.0.0', port=5002, debug=False, threaded=True)
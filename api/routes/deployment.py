@@ -1,90 +1,186 @@
 from flask import request, jsonify
 import os
 import uuid
-import tempfile
-from git import Repo
-import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
-from api.services.kubernetes import deploy_to_kubernetes, get_service_url
-from api.services.build import detect_project_type, detect_project_port
+from api.services.kubernetes import (
+    deploy_to_kubernetes, get_service_url, check_k8s_status,
+    delete_app_resources, list_app_deployments, render_manifests, find_free_port,
+    get_forwarded_url
+)
+from api.services.repository import clone_repository
+from api.services.build import (
+    prepare_docker_build, build_and_push_image, analyze_repository, pull_base_images,
+    wait_for_pulls, REGISTRY
+)
 
 logger = logging.getLogger(__name__)
 
+DEPLOY_WORKERS = 4
+LIST_WORKERS = 16
+LIST_POD_TIMEOUT = 2
+DEPLOY_JOB_TTL = 3600
+
+def clone_depth(data):
+    """Return the clone depth requested in a JSON body, None for full history
+
+    Raises ValueError if the depth isn't a positive integer.
+    """
+    if data.get('full_history'):
+        return None
+    depth = data.get('depth', 1)
+    # bool is an int subclass, but "depth": true is a mistake, not a depth of 1
+    if isinstance(depth, bool) or not isinstance(depth, int) or depth < 1:
+        raise ValueError("depth must be a positive integer")
+    return depth
+
 def register_routes(app, WORKDIR):
     @app.route('/health', methods=['GET'])
     def health_check():
         """Health check endpoint"""
-        from api.utils.shell import run_command
-        try:
-            nodes = run_command("kubectl get nodes")
-            k8s_status = "Ready" in nodes
-        except Exception:
-            k8s_status = False
-            
+        k8s_status = check_k8s_status()
+        
         return jsonify({
             "status": "healthy" if k8s_status else "unhealthy",
             "kubernetes": "running" if k8s_status else "not running"
         })
 
-    @app.route('/deploy', methods=['POST'])
-    def deploy_app():
-        """Deploy application from GitHub repo"""
-        data = request.json
-        
-        if not data or 'repo_url' not in data:
-            return jsonify({"error": "Missing required field: repo_url"}), 400
-        
-        repo_url = data['repo_url']
-        env_vars = data.get('env_vars', {})
-        
-        # Generate a unique ID for this deployment
-        deploy_id = str(uuid.uuid4())[:8]
-        
+    # Local mirrors of deployed repos, so redeploys only fetch new objects
+    MIRROR_DIR = os.path.join(WORKDIR, ".mirrors")
+
+    # Deploys run in the background; clients poll /status/<deploy_id>
+    deploy_executor = ThreadPoolExecutor(max_workers=DEPLOY_WORKERS)
+    # Kept apart from deploy_executor so removals don't queue behind pending deploys
+    cleanup_executor = ThreadPoolExecutor(max_workers=1)
+    # deploy_id -> (submitted_at, future), oldest first
+    deploy_jobs = {}
+
+    def prune_deploy_jobs():
+        """Forget finished deploys submitted more than DEPLOY_JOB_TTL seconds ago"""
+        cutoff = time.monotonic() - DEPLOY_JOB_TTL
+        for deploy_id, (submitted_at, future) in list(deploy_jobs.items()):
+            if submitted_at > cutoff:
+                break
+            if future.done():
+                deploy_jobs.pop(deploy_id, None)
+
+    def discard_checkout(project_dir):
+        """Remove a deploy's checkout in the background, off the deploy's critical path"""
+        cleanup_executor.submit(shutil.rmtree, project_dir, ignore_errors=True)
+
+    def run_deploy(deploy_id, repo_url, env_vars, depth):
+        """Clone, build and deploy a repo, returning the deployment details"""
         try:
             # 1. Clone the repository
             app_name = f"app-{deploy_id}"
             project_dir = os.path.join(WORKDIR, app_name)
             
-            logger.info(f"Cloning {repo_url} to {project_dir}")
-            Repo.clone_from(repo_url, project_dir)
+            # Base image pulls start as soon as the file list is known and
+            # overlap the fetch and checkout
+            pulls = []
+            repo = clone_repository(repo_url, project_dir, MIRROR_DIR, depth,
+                                    on_tree=lambda names: pulls.extend(pull_base_images(names)))
+            # Detection results are reused for later deploys of the same commit
+            cache_key = (repo_url, repo.head.commit.hexsha)
+            
+            # Drop git metadata so it isn't sent to the Docker daemon as build context
+            shutil.rmtree(os.path.join(project_dir, ".git"), ignore_errors=True)
             
             # 2. Check if Dockerfile exists, if not create one based on project type
-            from api.services.build import prepare_docker_build
-            project_type, dockerfile_path = prepare_docker_build(project_dir, env_vars)
+            project_type, dockerfile_path = prepare_docker_build(project_dir, env_vars, cache_key)
             
-            # 3. Build Docker image
-            from api.services.build import build_and_load_image
-            image_name = f"local-deploy/{app_name}:latest"
-            build_and_load_image(image_name, project_dir)
+            wait_for_pulls(pulls)
+            
+            # 3. Build Docker image, preparing everything else while it runs
+            image_name = f"{REGISTRY}/local-deploy/{app_name}:latest"
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                build = executor.submit(build_and_push_image, image_name, project_dir)
+                deployment, service = render_manifests(app_name, image_name, project_type, env_vars, project_dir, cache_key)
+                port = find_free_port()
+                build.result()
+            
+            # The image now holds everything the app needs, so the checkout
+            # can go instead of piling up in WORKDIR until shutdown
+            discard_checkout(project_dir)
             
             # 4. Create Kubernetes deployment
-            deploy_to_kubernetes(app_name, image_name, project_type, env_vars, project_dir, WORKDIR)
+            deploy_to_kubernetes(app_name, deployment, service)
             
             # 5. Get service URL
-            service_url = get_service_url(app_name)
+            service_url = get_service_url(app_name, port)
             
-            return jsonify({
+            return {
                 "status": "success",
                 "deployment_id": deploy_id,
                 "app_name": app_name,
                 "service_url": service_url
-            })
-            
+            }
         except Exception as e:
             logger.error(f"Deployment failed: {str(e)}")
+            discard_checkout(project_dir)
+            raise
+
+    @app.route('/deploy', methods=['POST'])
+    def deploy_app():
+        """Start deploying an application from GitHub repo"""
+        data = request.get_json(silent=True)
+        
+        if not data or 'repo_url' not in data:
+            return jsonify({"error": "Missing required field: repo_url"}), 400
+        
+        repo_url = data['repo_url']
+        env_vars = data.get('env_vars', {})
+        try:
+            depth = clone_depth(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Generate a unique ID for this deployment
+        deploy_id = str(uuid.uuid4())[:8]
+        prune_deploy_jobs()
+        deploy_jobs[deploy_id] = (time.monotonic(),
+                                  deploy_executor.submit(run_deploy, deploy_id, repo_url, env_vars, depth))
+        
+        return jsonify({
+            "status": "pending",
+            "deployment_id": deploy_id,
+            "app_name": f"app-{deploy_id}",
+            "status_url": f"/status/{deploy_id}"
+        }), 202
+
+    @app.route('/status/<deploy_id>', methods=['GET'])
+    def deploy_status(deploy_id):
+        """Report the progress of a deployment started with /deploy"""
+        job = deploy_jobs.get(deploy_id)
+        if job is None:
+            return jsonify({"error": f"Unknown deployment: {deploy_id}"}), 404
+        future = job[1]
+        
+        if not future.done():
+            return jsonify({
+                "status": "running" if future.running() else "pending",
+                "deployment_id": deploy_id,
+                "app_name": f"app-{deploy_id}"
+            })
+        
+        error = future.exception()
+        if error is not None:
             return jsonify({
                 "status": "error",
-                "error": str(e)
-            }), 500
+                "deployment_id": deploy_id,
+                "error": str(error)
+            })
+        
+        return jsonify(future.result())
 
     @app.route('/delete/<app_name>', methods=['DELETE'])
     def delete_deployment(app_name):
         """Delete an existing deployment"""
-        from api.utils.shell import run_command
         try:
-            run_command(f"kubectl delete service {app_name}")
-            run_command(f"kubectl delete deployment {app_name}")
+            delete_app_resources(app_name)
             
             return jsonify({
                 "status": "success",
@@ -100,30 +196,22 @@ def register_routes(app, WORKDIR):
     @app.route('/list', methods=['GET'])
     def list_deployments():
         """List all deployments"""
-        from api.utils.shell import run_command
         try:
-            deployments = run_command("kubectl get deployments -o jsonpath='{.items[*].metadata.name}'")
-            deployments_list = deployments.split() if deployments else []
+            deployments_list = [name for name in list_app_deployments() if name.startswith("app-")]
+            
+            def probe(app_name):
+                # Reuse an existing port-forward if it's still running. Pods
+                # that aren't up yet shouldn't hold the whole listing hostage
+                service_url = (get_forwarded_url(app_name)
+                               or get_service_url(app_name, pod_timeout=LIST_POD_TIMEOUT))
+                return {
+                    "app_name": app_name,
+                    "service_url": service_url
+                }
             
-            details = []
-            for app_name in deployments_list:
-                if app_name.startswith("app-"):
-                    # Check if there's an existing port-forward
-                    try:
-                        pf_process = run_command(f"ps aux | grep 'port-forward service/{app_name}' | grep -v grep")
-                        if pf_process:
-                            # Extract port from existing process
-                            port = re.search(r'(\d+):80', pf_process).group(1)
-                            service_url = f"http://localhost:{port}"
-                        else:
-                            service_url = get_service_url(app_name)
-                    except:
-                        service_url = get_service_url(app_name)
-                        
-                    details.append({
-                        "app_name": app_name,
-                        "service_url": service_url
-                    })
+            # Setting up a new port-forward waits on the cluster, so do them concurrently
+            with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+                details = list(executor.map(probe, deployments_list))
             
             return jsonify({
                 "status": "success",
@@ -139,14 +227,21 @@ def register_routes(app, WORKDIR):
     @app.route('/analyze', methods=['POST'])
     def analyze_repo():
         """Analyze a repo without deploying"""
-        data = request.json
+        data = request.get_json(silent=True)
+        
+        if not data or 'repo_url' not in data:
+            return jsonify({"error": "Missing required field: repo_url"}), 400
+        
         repo_url = data['repo_url']
+        try:
+            depth = clone_depth(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         deploy_id = str(uuid.uuid4())[:8]
         project_dir = os.path.join(WORKDIR, f"analyze-{deploy_id}")
         
         try:
-            from api.services.build import analyze_repository
-            analysis = analyze_repository(repo_url, project_dir)
+            analysis = analyze_repository(repo_url, project_dir, depth=depth)
             return jsonify(analysis)
         except Exception as e:
             logger.error(f"Analysis failed: {str(e)}")
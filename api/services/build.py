@@ -1,11 +1,16 @@
 import os
 import re
+import ast
+import mmap
 import shutil
 import logging
-from git import Repo
+import threading
+import time
+from collections import OrderedDict
 import subprocess
 
-from api.utils.shell import run_command
+from api.utils.shell import run_command, run_command_quiet
+from api.services.repository import clone_partial, cache_clone
 from config.templates.node import node_dockerfile
 from config.templates.python import python_dockerfile
 from config.templates.go import go_dockerfile
@@ -13,25 +18,108 @@ from config.templates.static import static_dockerfile
 
 logger = logging.getLogger(__name__)
 
-def detect_project_type(project_dir):
-    """Detect the type of project and return appropriate Dockerfile content"""
-    # Check for package.json (Node.js)
-    if os.path.exists(os.path.join(project_dir, "package.json")):
-        return "node", node_dockerfile
+DETECTION_CACHE_SIZE = 128
+
+# Local registry started by cli/create_cluster.py, reachable from the host and kind nodes
+REGISTRY = "localhost:5001"
+PULL_TIMEOUT = 300
+
+# Paths never needed inside the image, kept out of the build context
+DOCKERIGNORE = """.git
+node_modules
+__pycache__
+*.pyc
+.venv
+venv
+*.log
+"""
+
+DOCKERFILES = {
+    "node": node_dockerfile,
+    "python": python_dockerfile,
+    "go": go_dockerfile,
+    "static": static_dockerfile
+}
+
+# Marker file -> project type, checked in order
+PROJECT_SIGNATURES = [
+    ("package.json", "node"),
+    ("requirements.txt", "python"),
+    ("go.mod", "go")
+]
+
+# Port declarations, one alternation per project type so each file is scanned
+# once. Patterns are bytes so they can run directly over a memory-mapped file
+_NODE_PORT_RE = re.compile(
+    rb"\.listen\s*\(\s*(?P<listen>\d+)"                # app.listen(3000)
+    rb"|(?:port|PORT)\s*=\s*(?P<assign>\d+)"          # port = 3000, PORT = 3000
+    rb"|process\.env\.PORT\s*\|\|\s*(?P<env>\d+)"      # process.env.PORT || 3000
+)
+
+_PYTHON_PORT_RE = re.compile(
+    rb"app\.run\s*\(\s*.*port\s*=\s*(?P<run>\d+)"     # app.run(port=5000)
+    rb"|(?:port|PORT)\s*=\s*(?P<assign>\d+)"          # port = 5000, PORT = 5000
+    rb"|int\(os\.environ\.get\('PORT',\s*'(?P<env>\d+)'\)"  # int(os.environ.get('PORT', '5000'))
+)
+
+_ENV_KEY_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+_BASE_IMAGE_RE = re.compile(r"^FROM\s+(\S+)", re.MULTILINE)
+
+ANALYZE_PORT_FILES = ["index.js", "server.js", "app.js", "app.py", "main.go"]
+
+_ANALYZE_PORT_RE = re.compile(
+    rb"\.listen\s*\(\s*(?P<listen>\d+)"                # app.listen(3000)
+    rb"|(?:port|PORT)\s*=\s*(?P<assign>\d+)"          # port = 3000, PORT = 3000
+)
+
+# Detection results keyed by (kind, (repo_url, commit_sha)), oldest evicted first
+_detection_cache = OrderedDict()
+_detection_lock = threading.Lock()
+
+def _cached_detection(kind, cache_key, compute):
+    """Return a memoized detection result for a commit, computing it on a miss"""
+    if cache_key is None:
+        return compute()
     
-    # Check for requirements.txt (Python)
-    elif os.path.exists(os.path.join(project_dir, "requirements.txt")):
-        return "python", python_dockerfile
+    key = (kind, cache_key)
+    with _detection_lock:
+        if key in _detection_cache:
+            _detection_cache.move_to_end(key)
+            return _detection_cache[key]
     
-    # Check for go.mod (Go)
-    elif os.path.exists(os.path.join(project_dir, "go.mod")):
-        return "go", go_dockerfile
+    value = compute()
+    with _detection_lock:
+        _detection_cache[key] = value
+        if len(_detection_cache) > DETECTION_CACHE_SIZE:
+            _detection_cache.popitem(last=False)
+    return value
+
+def detect_project_type(project_dir, cache_key=None, entries=None):
+    """Detect the type of project and return appropriate Dockerfile content"""
+    project_type = _cached_detection("type", cache_key, lambda: _scan_project_type(project_dir, entries))
+    return project_type, DOCKERFILES[project_type]
+
+def list_project_files(project_dir):
+    """Return the names of the regular files at the top of the project"""
+    with os.scandir(project_dir) as it:
+        return {entry.name for entry in it if entry.is_file()}
+
+def _scan_project_type(project_dir, entries=None):
+    if entries is None:
+        entries = list_project_files(project_dir)
+    return project_type_from_names(entries)
+
+def project_type_from_names(entries):
+    """Pick the project type from the names of the top-level files"""
+    for filename, project_type in PROJECT_SIGNATURES:
+        if filename in entries:
+            return project_type
     
     # Default to a simple static html site
-    else:
-        return "static", static_dockerfile
+    return "static"
 
-def detect_project_port(project_dir, project_type, env_vars):
+def detect_project_port(project_dir, project_type, env_vars, cache_key=None, entries=None):
     """Auto-detect the port that the application will run on"""
     default_ports = {
         "node": 3000,
@@ -47,125 +135,245 @@ def detect_project_port(project_dir, project_type, env_vars):
         except ValueError:
             logger.warning(f"Invalid PORT in env_vars: {env_vars['PORT']}, using default")
     
+    port = _cached_detection(("port", project_type), cache_key,
+                             lambda: _scan_project_port(project_dir, project_type, entries))
+    if port is not None:
+        return port
+    
+    return default_ports.get(project_type, 80)
+
+def _find_port(file_path, pattern):
+    """Return the first port a file declares, scanning it in a single pass"""
+    with open(file_path, 'rb') as f:
+        # Empty files can't be memory-mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            matches = pattern.search(content)
+            if matches:
+                return int(next(g for g in matches.groups() if g))
+    return None
+
+def _find_python_port(file_path):
+    """Return the port a Python entry point runs on, read from its syntax tree"""
+    with open(file_path, 'rb') as f:
+        source = f.read()
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        # Not parseable (e.g. Python 2), fall back to pattern matching
+        return _find_port(file_path, _PYTHON_PORT_RE)
+    
+    # Simple assignments, so app.run(port=PORT) can be resolved
+    assignments = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    assignments[target.id] = node.value
+    
+    # app.run(port=...), server.run(port=...), uvicorn.run(app, port=...)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "run":
+            for keyword in node.keywords:
+                if keyword.arg == "port":
+                    port = _port_from_node(keyword.value, assignments)
+                    if port is not None:
+                        return port
+    
+    # port = 5000, PORT = int(os.environ.get('PORT', '5000'))
+    for name in ("port", "PORT"):
+        if name in assignments:
+            port = _port_from_node(assignments[name], assignments)
+            if port is not None:
+                return port
+    
+    # The default of any os.environ.get('PORT', ...) lookup
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr in ("get", "getenv") and len(node.args) >= 2
+                and isinstance(node.args[0], ast.Constant) and node.args[0].value == "PORT"):
+            port = _port_from_node(node.args[1], assignments)
+            if port is not None:
+                return port
+    return None
+
+def _port_from_node(node, assignments, depth=0):
+    """Evaluate the few expression shapes used to declare a port"""
+    if depth > 5:
+        return None
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, str)) and str(node.value).isdigit():
+        return int(node.value)
+    if isinstance(node, ast.Name) and node.id in assignments:
+        return _port_from_node(assignments[node.id], assignments, depth + 1)
+    if isinstance(node, ast.Call):
+        # int(...)
+        if isinstance(node.func, ast.Name) and node.func.id == "int" and node.args:
+            return _port_from_node(node.args[0], assignments, depth + 1)
+        # os.environ.get('PORT', 5000), os.getenv('PORT', 5000)
+        if isinstance(node.func, ast.Attribute) and node.func.attr in ("get", "getenv") and len(node.args) >= 2:
+            return _port_from_node(node.args[1], assignments, depth + 1)
+    return None
+
+def _scan_project_port(project_dir, project_type, entries=None):
+    if entries is None:
+        entries = list_project_files(project_dir)
+    
     # For Node.js, try to find port in code
     if project_type == "node":
         # Check common files
         for filename in ["index.js", "server.js", "app.js"]:
-            file_path = os.path.join(project_dir, filename)
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as f:
-                    content = f.read()
-                    # Look for common port declarations
-                    for pattern in [
-                        r"\.listen\s*\(\s*(\d+)",  # app.listen(3000)
-                        r"port\s*=\s*(\d+)",       # port = 3000
-                        r"PORT\s*=\s*(\d+)",       # PORT = 3000
-                        r"process\.env\.PORT\s*\|\|\s*(\d+)" # process.env.PORT || 3000
-                    ]:
-                        matches = re.search(pattern, content)
-                        if matches:
-                            try:
-                                return int(matches.group(1))
-                            except ValueError:
-                                continue
+            if filename in entries:
+                port = _find_port(os.path.join(project_dir, filename), _NODE_PORT_RE)
+                if port is not None:
+                    return port
     
     # For Flask, try to find port in code
     if project_type == "python":
         # Check common files
         for filename in ["app.py", "main.py", "run.py"]:  # Common Flask entry points
-            file_path = os.path.join(project_dir, filename)
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as f:
-                    content = f.read()
-                    # Look for common port declarations
-                    for pattern in [
-                        r"app\.run\s*\(\s*.*port\s*=\s*(\d+)",  # app.run(port=5000)
-                        r"port\s*=\s*(\d+)",                    # port = 5000
-                        r"PORT\s*=\s*(\d+)",                    # PORT = 5000
-                        r"int\(os\.environ\.get\('PORT',\s*'(\d+)'\)",  # int(os.environ.get('PORT', '5000'))
-                    ]:
-                        matches = re.search(pattern, content)
-                        if matches:
-                            try:
-                                return int(matches.group(1))
-                            except ValueError:
-                                continue
+            if filename in entries:
+                port = _find_python_port(os.path.join(project_dir, filename))
+                if port is not None:
+                    return port
     
-    return default_ports.get(project_type, 80)
+    return None
 
-def prepare_docker_build(project_dir, env_vars):
+def pull_base_images(names):
+    """Start pulling the base images of the Dockerfile that will be generated
+
+    Returns the running pull processes. Repos with their own Dockerfile are skipped.
+    """
+    if "Dockerfile" in names:
+        return []
+    
+    dockerfile = DOCKERFILES[project_type_from_names(set(names))]
+    procs = []
+    # Multi-stage templates can name the same image more than once
+    for image in dict.fromkeys(_BASE_IMAGE_RE.findall(dockerfile)):
+        logger.info(f"Pulling base image {image} in the background")
+        procs.append(subprocess.Popen(["docker", "pull", image],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    return procs
+
+def wait_for_pulls(procs, timeout=PULL_TIMEOUT):
+    """Wait for background base image pulls, killing any still running at the timeout
+
+    A pull that didn't finish only costs the build its head start, it pulls the image itself.
+    """
+    deadline = time.monotonic() + timeout
+    for proc in procs:
+        try:
+            proc.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Base image pull {proc.args[-1]} timed out, leaving it to the build")
+            proc.kill()
+            proc.wait()
+
+def render_env(env_vars):
+    """Render env vars as Dockerfile ENV instructions"""
+    lines = []
+    for key, value in env_vars.items():
+        if not _ENV_KEY_RE.match(key):
+            logger.warning(f"Skipping invalid environment variable name: {key}")
+            continue
+        # A line break would end the ENV instruction and start a new one
+        if "\n" in str(value) or "\r" in str(value):
+            logger.warning(f"Skipping environment variable with a line break in its value: {key}")
+            continue
+        # Quote the value, escaping what Dockerfile double quotes would interpret
+        quoted = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("$", "\\$")
+        lines.append(f'ENV {key}="{quoted}"')
+    return "\n".join(lines)
+
+def prepare_docker_build(project_dir, env_vars, cache_key=None):
     """Prepare project for Docker build"""
     # Check if Dockerfile exists, if not create one based on project type
     dockerfile_path = os.path.join(project_dir, "Dockerfile")
     project_type = "static"  # Default
     
-    if not os.path.exists(dockerfile_path):
+    # List the directory once and answer every existence check from it
+    entries = list_project_files(project_dir)
+    
+    if "Dockerfile" not in entries:
         logger.info("No Dockerfile found, detecting project type...")
-        project_type, dockerfile_content = detect_project_type(project_dir)
+        project_type, dockerfile_content = detect_project_type(project_dir, cache_key, entries)
         logger.info(f"Detected project type: {project_type}")
         
-        # Create the Dockerfile
+        # Create the Dockerfile with the env vars baked in
         with open(dockerfile_path, "w") as f:
-            f.write(dockerfile_content)
+            f.write(dockerfile_content.replace("{env}", render_env(env_vars)))
         
         logger.info(f"Created {project_type} Dockerfile")
+    else:
+        # The repo's own Dockerfile decides how to use them, so hand them over as .env
+        if ".env" not in entries and env_vars:
+            with open(os.path.join(project_dir, ".env"), "w") as f:
+                for key, value in env_vars.items():
+                    f.write(f"{key}={value}\n")
+            logger.info("Created .env file")
     
-    # Create .env file if it doesn't exist
-    env_file_path = os.path.join(project_dir, ".env")
-    if not os.path.exists(env_file_path) and env_vars:
-        with open(env_file_path, "w") as f:
-            for key, value in env_vars.items():
-                f.write(f"{key}={value}\n")
-        logger.info("Created .env file")
+    # Keep the build context small unless the repo brings its own ignore rules
+    if ".dockerignore" not in entries:
+        with open(os.path.join(project_dir, ".dockerignore"), "w") as f:
+            f.write(DOCKERIGNORE)
     
     return project_type, dockerfile_path
 
-def build_and_load_image(image_name, project_dir):
-    """Build Docker image and load into kind cluster"""
+def build_and_push_image(image_name, project_dir):
+    """Build Docker image and push it to the local registry the cluster pulls from"""
     logger.info(f"Building Docker image: {image_name}")
     
     try:
-        run_command(f"docker build -t {image_name} .", cwd=project_dir)
+        # BuildKit keeps RUN --mount=type=cache directories between builds, so
+        # dependency downloads are reused across deploys. Build output is
+        # logged as it arrives so long builds show progress
+        run_command(["docker", "build", "-t", image_name, "."],
+                    cwd=project_dir, env={"DOCKER_BUILDKIT": "1"})
         
-        # Load the image into kind
-        logger.info(f"Loading image into kind cluster...")
-        run_command(f"kind load docker-image {image_name} --name orca")
+        # Push to the registry; only layers it doesn't have yet are uploaded
+        logger.info(f"Pushing image to {REGISTRY}...")
+        run_command_quiet(["docker", "push", image_name])
     except subprocess.CalledProcessError as e:
-        logger.error(f"Docker build or load failed: {e.stderr}")
-        raise Exception(f"Docker build or load failed: {e.stderr}")
+        logger.error(f"Docker build or push failed: {e.stderr}")
+        raise Exception(f"Docker build or push failed: {e.stderr}")
 
-def analyze_repository(repo_url, project_dir):
+def analyze_repository(repo_url, project_dir, depth=1):
     """Analyze repository for project type and ports"""
     try:
-        Repo.clone_from(repo_url, project_dir)
-        project_type, _ = detect_project_type(project_dir)
+        # Only the marker and entry point files are read, so skip downloading the rest
+        wanted = {filename for filename, _ in PROJECT_SIGNATURES} | set(ANALYZE_PORT_FILES)
+        repo, names = clone_partial(repo_url, project_dir, wanted, depth)
+        entries = set(names)
+        project_type, _ = detect_project_type(project_dir, (repo_url, repo.head.commit.hexsha), entries)
         
         # Look for port info in common files
         port_info = {}
-        for filename in ["index.js", "server.js", "app.js", "app.py", "main.go"]:
-            file_path = os.path.join(project_dir, filename)
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as f:
-                    content = f.read()
-                    port_info[filename] = {}
-                    
-                    # Look for port declarations
-                    for pattern in [
-                        r"\.listen\s*\(\s*(\d+)",  # app.listen(3000)
-                        r"port\s*=\s*(\d+)",       # port = 3000
-                        r"PORT\s*=\s*(\d+)"        # PORT = 3000
-                    ]:
-                        matches = re.search(pattern, content)
-                        if matches:
-                            port_info[filename]["detected_port"] = matches.group(1)
+        for filename in ANALYZE_PORT_FILES:
+            if filename in entries:
+                port_info[filename] = {}
+                
+                # Look for port declarations. Only the named paths are checked
+                # out, so symlinks can dangle and directories share the names
+                try:
+                    port = _find_port(os.path.join(project_dir, filename), _ANALYZE_PORT_RE)
+                except OSError as e:
+                    logger.warning(f"Could not read {filename}: {str(e)}")
+                    continue
+                if port is not None:
+                    port_info[filename]["detected_port"] = str(port)
+        
+        # Keep the clone so a following deploy of this repo can reuse it
+        cache_clone(repo_url, project_dir, depth)
         
         return {
             "repo_url": repo_url,
             "project_type": project_type,
-            "files": os.listdir(project_dir),
+            "files": names,
             "port_info": port_info
         }
-    finally:
+    except Exception:
         # Clean up temp directory
         if os.path.exists(project_dir):
-            shutil.rmtree(project_dir)
\ No newline at end of file
+            shutil.rmtree(project_dir)
+        raise
\ No newline at end of file
@@ -1,30 +1,71 @@
-import os
-import yaml
 import subprocess
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import socket
-import re
 
-from api.utils.shell import run_command
+from kubernetes import client, config, watch
+
+from api.utils.ttl_cache import cached_call, invalidate
 from api.services.build import detect_project_port
 
 logger = logging.getLogger(__name__)
 
-def deploy_to_kubernetes(app_name, image_name, project_type="static", env_vars=None, project_dir=None, workdir=None):
-    """Deploy the application to Kubernetes"""
+NAMESPACE = "default"
+ROLLOUT_TIMEOUT = 300
+POD_START_TIMEOUT = 60
+PORT_FORWARD_TIMEOUT = 5
+K8S_STATUS_TTL = 5.0
+K8S_STATUS_TIMEOUT = 1
+DEPLOYMENTS_TTL = 1.5
+
+# Load kubeconfig once and share the API clients (and their connection pool)
+# across requests instead of paying kubectl startup on every call
+try:
+    config.load_kube_config()
+except config.ConfigException as e:
+    logger.warning(f"Could not load kubeconfig: {e}")
+
+api_client = client.ApiClient()
+apps_v1 = client.AppsV1Api(api_client)
+core_v1 = client.CoreV1Api(api_client)
+
+# Port-forwards started by this process: app_name -> (port, Popen)
+_port_forwards = {}
+_port_forwards_lock = threading.Lock()
+
+def check_k8s_status():
+    """Return True if at least one cluster node reports Ready, cached briefly"""
+    return cached_call("k8s_status", _fetch_k8s_status, K8S_STATUS_TTL)
+
+def _fetch_k8s_status():
+    try:
+        # Fail fast so a hung API server reads as unhealthy instead of blocking /health
+        nodes = core_v1.list_node(_request_timeout=K8S_STATUS_TIMEOUT).items
+    except Exception:
+        return False
+    
+    for node in nodes:
+        for condition in node.status.conditions or []:
+            if condition.type == "Ready" and condition.status == "True":
+                return True
+    return False
+
+def render_manifests(app_name, image_name, project_type="static", env_vars=None, project_dir=None, cache_key=None):
+    """Build the deployment and service manifests for an app"""
     if env_vars is None:
         env_vars = {}
     
     # Detect port from the project
-    container_port = detect_project_port(project_dir, project_type, env_vars)
+    container_port = detect_project_port(project_dir, project_type, env_vars, cache_key)
     logger.info(f"Detected application port: {container_port}")
     
     # Create deployment YAML
     deployment = {
         "apiVersion": "apps/v1",
         "kind": "Deployment",
-        "metadata": {"name": app_name},
+        "metadata": {"name": app_name, "labels": {"app": app_name}},
         "spec": {
             "replicas": 1,
             "selector": {"matchLabels": {"app": app_name}},
@@ -35,7 +76,7 @@ def deploy_to_kubernetes(app_name, image_name, project_type="static", env_vars=N
                         "name": app_name,
                         "image": image_name,
                         "ports": [{"containerPort": container_port}],
-                        "imagePullPolicy": "Never"  # Use local image
+                        "imagePullPolicy": "IfNotPresent"  # Pulled from the local registry
                     }]
                 }
             }
@@ -46,7 +87,7 @@ def deploy_to_kubernetes(app_name, image_name, project_type="static", env_vars=N
     service = {
         "apiVersion": "v1",
         "kind": "Service",
-        "metadata": {"name": app_name},
+        "metadata": {"name": app_name, "labels": {"app": app_name}},
         "spec": {
             "selector": {"app": app_name},
             "ports": [{"port": 80, "targetPort": container_port}],
@@ -54,56 +95,148 @@ def deploy_to_kubernetes(app_name, image_name, project_type="static", env_vars=N
         }
     }
     
-    # Write YAML files
-    deploy_file = os.path.join(workdir, f"{app_name}-deployment.yaml")
-    service_file = os.path.join(workdir, f"{app_name}-service.yaml")
-    
-    with open(deploy_file, "w") as f:
-        yaml.dump(deployment, f)
-    with open(service_file, "w") as f:
-        yaml.dump(service, f)
-    
-    # Apply to Kubernetes
-    run_command(f"kubectl apply -f {deploy_file}")
-    run_command(f"kubectl apply -f {service_file}")
+    return deployment, service
+
+def deploy_to_kubernetes(app_name, deployment, service):
+    """Apply the manifests to Kubernetes and wait for the rollout"""
+    # The two objects are independent, so create them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(apps_v1.create_namespaced_deployment, namespace=NAMESPACE, body=deployment),
+            executor.submit(core_v1.create_namespaced_service, namespace=NAMESPACE, body=service)
+        ]
+        for future in futures:
+            future.result()
+    invalidate()
     
     # Wait for deployment to be ready
-    run_command(f"kubectl rollout status deployment/{app_name}")
+    wait_for_rollout(app_name)
+
+def wait_for_rollout(app_name, timeout=ROLLOUT_TIMEOUT):
+    """Block until all replicas of a deployment are ready, driven by watch events"""
+    w = watch.Watch()
+    for event in w.stream(apps_v1.list_namespaced_deployment,
+                          namespace=NAMESPACE,
+                          label_selector=f"app={app_name}",
+                          timeout_seconds=timeout):
+        deployment = event['object']
+        ready = deployment.status.ready_replicas or 0
+        logger.info(f"Rollout of {app_name}: {ready}/{deployment.spec.replicas} replicas ready")
+        if ready == deployment.spec.replicas:
+            w.stop()
+            return
+    
+    raise Exception(f"Timed out waiting for deployment {app_name} to become ready")
 
-def get_service_url(app_name):
+def wait_for_pod_running(app_name, timeout=POD_START_TIMEOUT):
+    """Block until a pod of the app is running and return the last phase seen"""
+    phase = None
+    w = watch.Watch()
+    for event in w.stream(core_v1.list_namespaced_pod,
+                          namespace=NAMESPACE,
+                          label_selector=f"app={app_name}",
+                          timeout_seconds=timeout):
+        phase = event['object'].status.phase
+        if phase == "Running":
+            w.stop()
+            break
+    return phase
+
+def wait_for_port(port, timeout=PORT_FORWARD_TIMEOUT, interval=0.02):
+    """Poll until a local port accepts connections, returning False on timeout"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(("localhost", port), timeout=timeout):
+                return True
+        except OSError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+
+def find_free_port():
+    """Ask the OS for a currently unused local port"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def get_service_url(app_name, port=None, pod_timeout=POD_START_TIMEOUT):
     """Set up port-forwarding and return localhost URL"""
     try:
         # Find an available port
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('', 0))
-        port = s.getsockname()[1]
-        s.close()
+        if port is None:
+            port = find_free_port()
         
-        # Kill any existing port-forward for this service
-        try:
-            subprocess.run(f"pkill -f 'kubectl port-forward service/{app_name}'", 
-                          shell=True, stderr=subprocess.PIPE)
-        except:
-            pass
+        # Stop any existing port-forward for this service
+        stop_port_forward(app_name)
         
-        # Get the pod to check if it's ready
-        time.sleep(2)  # Give k8s a moment to start the pod
-        pod_status = run_command(f"kubectl get pods -l app={app_name} -o jsonpath='{{.items[0].status.phase}}'")
+        # Wait for the pod to be running before forwarding to it
+        pod_status = wait_for_pod_running(app_name, pod_timeout)
         logger.info(f"Pod status: {pod_status}")
         
         # Start port-forwarding in the background with address binding
-        cmd = f"nohup kubectl port-forward service/{app_name} {port}:80 --address 0.0.0.0 > /tmp/port-forward-{app_name}.log 2>&1 &"
-        subprocess.Popen(cmd, shell=True)
+        with open(f"/tmp/port-forward-{app_name}.log", "wb") as log_file:
+            proc = subprocess.Popen(
+                ["kubectl", "port-forward", f"service/{app_name}", f"{port}:80", "--address", "0.0.0.0"],
+                stdout=log_file,
+                stderr=subprocess.STDOUT
+            )
+        with _port_forwards_lock:
+            _port_forwards[app_name] = (port, proc)
         
         logger.info(f"Started port-forwarding for {app_name} on port {port}")
-        time.sleep(2)  # Give port-forward a moment to establish
         
         # Verify port-forwarding is working
-        pf_process = run_command(f"ps aux | grep 'port-forward service/{app_name}' | grep -v grep")
-        if not pf_process:
-            logger.warning("Port-forwarding process not found, but continuing")
+        if not wait_for_port(port):
+            logger.warning("Port-forwarding not accepting connections, but continuing")
         
         return f"http://localhost:{port}"
     except Exception as e:
         logger.error(f"Error setting up port forwarding: {str(e)}")
-        return "Could not set up port forwarding"
\ No newline at end of file
+        return "Could not set up port forwarding"
+
+def get_forwarded_url(app_name):
+    """Return the URL of a running port-forward for an app, or None"""
+    entry = _port_forwards.get(app_name)
+    if entry is None or entry[1].poll() is not None:
+        return None
+    return f"http://localhost:{entry[0]}"
+
+def stop_port_forward(app_name):
+    """Terminate the port-forward started for an app, if any"""
+    with _port_forwards_lock:
+        entry = _port_forwards.pop(app_name, None)
+    if entry is None:
+        return
+    
+    proc = entry[1]
+    proc.terminate()
+    try:
+        proc.wait(timeout=PORT_FORWARD_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def delete_app_resources(app_name):
+    """Delete the service and deployment created for an app"""
+    stop_port_forward(app_name)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(core_v1.delete_namespaced_service, name=app_name, namespace=NAMESPACE),
+            executor.submit(apps_v1.delete_namespaced_deployment, name=app_name, namespace=NAMESPACE)
+        ]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            invalidate()
+
+def list_app_deployments():
+    """Return the names of all deployments in the namespace, cached briefly"""
+    return list(cached_call("deployments", _fetch_deployment_names, DEPLOYMENTS_TTL))
+
+def _fetch_deployment_names():
+    deployments = apps_v1.list_namespaced_deployment(namespace=NAMESPACE).items
+    return tuple(d.metadata.name for d in deployments)
\ No newline at end of file
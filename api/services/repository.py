@@ -0,0 +1,198 @@
+import os
+import shutil
+import hashlib
+import threading
+import time
+import logging
+from collections import OrderedDict, defaultdict
+from git import Repo
+
+logger = logging.getLogger(__name__)
+
+REPO_CACHE_SIZE = 16
+MIRROR_CACHE_SIZE = 16
+REFRESH_INTERVAL = 60
+REFRESH_TIMEOUT = 120
+
+# Clones kept around after /analyze so a following /deploy of the same repo
+# can copy them instead of going back to the network.
+# repo_url -> (clone_dir, depth), least recently used first
+_repo_cache = OrderedDict()
+_repo_cache_lock = threading.Lock()
+_refresher = None
+
+# Per-URL locks held while a cached clone is copied, refreshed or removed, so
+# that slow disk and network work never holds up the cache as a whole
+_clone_locks = defaultdict(threading.Lock)
+
+# Per-URL locks so concurrent deploys of one repo don't update its mirror at once
+_mirror_locks = defaultdict(threading.Lock)
+# repo_url -> mirror_path, least recently deployed first
+_mirrors = OrderedDict()
+
+def clone_repository(repo_url, project_dir, mirror_root, depth=1, on_tree=None):
+    """Clone the tip of a repo into project_dir, reusing a cached clone when possible
+
+    Otherwise objects are fetched into a local mirror kept under mirror_root and
+    the clone is made from that, so repeated deploys only download new objects.
+    If given, on_tree is called once with the names of the top-level entries as
+    soon as they are known: for an existing mirror that is its tree from before
+    the fetch, so the callback overlaps the download.
+    """
+    cached = None
+    with _repo_cache_lock:
+        entry = _repo_cache.get(repo_url)
+        if entry is not None and entry[1] == depth:
+            _repo_cache.move_to_end(repo_url)
+            cached = entry[0]
+            clone_lock = _clone_locks[repo_url]
+    
+    if cached is not None:
+        with clone_lock:
+            # It may have been evicted while waiting for the lock
+            if os.path.isdir(cached):
+                logger.info(f"Copying cached clone of {repo_url} to {project_dir}")
+                shutil.copytree(cached, project_dir, symlinks=True)
+            else:
+                cached = None
+
+    if cached is not None:
+        # The cached clone may lag the remote by up to a refresh cycle, so catch
+        # up first. It is blobless, so this only fetches commits and trees and the
+        # missing file contents are downloaded by the checkout below
+        repo = Repo(project_dir)
+        fetch_args = [f"--depth={depth}"] if depth else []
+        repo.git.fetch(*fetch_args, "origin")
+        if on_tree is not None:
+            on_tree(repo.git.ls_tree("--name-only", "FETCH_HEAD").splitlines())
+        repo.git.reset("--hard", "FETCH_HEAD")
+        return repo
+
+    evicted = []
+    with _repo_cache_lock:
+        mirror_lock = _mirror_locks[repo_url]
+        _mirrors[repo_url] = mirror_path(repo_url, mirror_root)
+        _mirrors.move_to_end(repo_url)
+        while len(_mirrors) > MIRROR_CACHE_SIZE:
+            evicted.append(_mirrors.popitem(last=False))
+    
+    try:
+        with mirror_lock:
+            # The tip rarely changes which top-level files exist, so an existing
+            # mirror's tree is a good enough guess to start on before fetching
+            path = mirror_path(repo_url, mirror_root)
+            if on_tree is not None and os.path.exists(path):
+                on_tree(Repo(path).git.ls_tree("--name-only", "HEAD").splitlines())
+                on_tree = None
+            mirror = update_mirror(repo_url, mirror_root, depth)
+            if on_tree is not None:
+                on_tree(mirror.git.ls_tree("--name-only", "HEAD").splitlines())
+            # Local clones hardlink the mirror's objects instead of copying them
+            logger.info(f"Cloning mirror of {repo_url} to {project_dir}")
+            return Repo.clone_from(mirror.git_dir, project_dir)
+    finally:
+        for evicted_url, evicted_path in evicted:
+            _remove_mirror(evicted_url, evicted_path)
+
+def mirror_path(repo_url, mirror_root):
+    """Return where the local mirror of a repo is kept"""
+    return os.path.join(mirror_root, hashlib.sha1(repo_url.encode()).hexdigest())
+
+def _remove_mirror(repo_url, path):
+    with _repo_cache_lock:
+        mirror_lock = _mirror_locks[repo_url]
+    # Wait for any deploy using it to finish
+    with mirror_lock:
+        with _repo_cache_lock:
+            # Deployed again since it was evicted
+            if repo_url in _mirrors:
+                return
+        logger.info(f"Removing mirror of {repo_url}")
+        shutil.rmtree(path, ignore_errors=True)
+
+def update_mirror(repo_url, mirror_root, depth=1):
+    """Create or fast-forward the bare local mirror of a repo's default branch"""
+    path = mirror_path(repo_url, mirror_root)
+    if not os.path.exists(path):
+        logger.info(f"Creating mirror of {repo_url} at {path}")
+        os.makedirs(mirror_root, exist_ok=True)
+        return Repo.clone_from(repo_url, path, bare=True, depth=depth, single_branch=True, no_tags=True)
+
+    logger.info(f"Updating mirror of {repo_url}")
+    mirror = Repo(path)
+    branch = mirror.git.symbolic_ref("HEAD")
+    if depth:
+        fetch_args = [f"--depth={depth}"]
+    elif os.path.exists(os.path.join(path, "shallow")):
+        # A plain fetch keeps a shallow mirror shallow, full history has to be asked for
+        fetch_args = ["--unshallow"]
+    else:
+        fetch_args = []
+    mirror.git.fetch(*fetch_args, "--no-tags", "origin", f"+HEAD:{branch}")
+    return mirror
+
+def clone_partial(repo_url, project_dir, paths, depth=1):
+    """Clone only the commit and tree objects of a repo, checking out just the given top-level paths
+
+    Returns the repo and the names of all top-level entries in its tree.
+    """
+    logger.info(f"Cloning tree of {repo_url} to {project_dir}")
+    repo = Repo.clone_from(repo_url, project_dir, depth=depth, single_branch=True, no_tags=True,
+                           multi_options=["--filter=blob:none", "--no-checkout"])
+
+    names = repo.git.ls_tree("--name-only", "HEAD").splitlines()
+    wanted = [name for name in names if name in paths]
+    if wanted:
+        # Fetches just these blobs from the remote
+        repo.git.checkout("HEAD", "--", *wanted)
+    return repo, names
+
+def cache_clone(repo_url, project_dir, depth=1):
+    """Keep a finished clone for reuse, evicting the least recently used one"""
+    global _refresher
+
+    evicted = []
+    with _repo_cache_lock:
+        if repo_url in _repo_cache:
+            evicted.append((_clone_locks[repo_url], _repo_cache.pop(repo_url)[0]))
+        _repo_cache[repo_url] = (project_dir, depth)
+        while len(_repo_cache) > REPO_CACHE_SIZE:
+            evicted_url, (clone_dir, _) = _repo_cache.popitem(last=False)
+            evicted.append((_clone_locks[evicted_url], clone_dir))
+
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_loop, name="repo-cache-refresh", daemon=True)
+            _refresher.start()
+
+    for clone_lock, clone_dir in evicted:
+        if clone_dir != project_dir:
+            # Wait for any copy or refresh of it to finish
+            with clone_lock:
+                shutil.rmtree(clone_dir, ignore_errors=True)
+
+def _refresh_loop():
+    """Periodically fast-forward cached clones so reused copies stay current"""
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        with _repo_cache_lock:
+            entries = list(_repo_cache.items())
+
+        for repo_url, (clone_dir, depth) in entries:
+            with _repo_cache_lock:
+                clone_lock = _clone_locks[repo_url]
+            
+            # Only this repo's deploys wait on the fetch, and only up to the timeout
+            with clone_lock:
+                with _repo_cache_lock:
+                    current = _repo_cache.get(repo_url, (None,))[0] == clone_dir
+                # Skip clones evicted since the snapshot
+                if not current:
+                    continue
+                try:
+                    repo = Repo(clone_dir)
+                    fetch_args = [f"--depth={depth}"] if depth else []
+                    repo.git.fetch(*fetch_args, "origin", kill_after_timeout=REFRESH_TIMEOUT)
+                    # Move HEAD only, the tree is checked out when the clone is reused
+                    repo.git.reset("--soft", "FETCH_HEAD")
+                except Exception as e:
+                    logger.warning(f"Failed to refresh cached clone of {repo_url}: {str(e)}")
@@ -44,6 +44,27 @@ if [ -z "$APP_NAME" ]; then
   exit 1
 fi
 
+echo -e "${GREEN}Started deployment of application with name: $APP_NAME${NC}"
+
+# Poll the deployment status until it finishes
+DEPLOY_ID=$(echo $DEPLOY_RESPONSE | jq -r '.deployment_id')
+echo -e "${YELLOW}Waiting for deployment to finish...${NC}"
+while true; do
+  STATUS_RESPONSE=$(curl -s http://localhost:5002/status/$DEPLOY_ID)
+  STATUS=$(echo $STATUS_RESPONSE | jq -r '.status')
+  if [ "$STATUS" != "pending" ] && [ "$STATUS" != "running" ]; then
+    break
+  fi
+  sleep 2
+done
+
+echo "Status response: $STATUS_RESPONSE"
+
+if [ "$STATUS" != "success" ]; then
+  echo -e "${RED}Deployment failed.${NC}"
+  exit 1
+fi
+
 echo -e "${GREEN}Deployed application with name: $APP_NAME${NC}"
 
 # List deployments
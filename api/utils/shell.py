@@ -1,17 +1,62 @@
+import os
+import shlex
 import subprocess
 import logging
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
-def run_command(command, cwd=None):
-    """Run a shell command and return output"""
+OUTPUT_TAIL_LINES = 200
+
+def to_argv(command):
+    """Split a command string into arguments, passing argument lists through"""
+    if isinstance(command, str):
+        return shlex.split(command)
+    return list(command)
+
+def _merged_env(env):
+    """Overlay extra variables on the current environment"""
+    if not env:
+        return None
+    return {**os.environ, **env}
+
+def run_command(command, cwd=None, env=None):
+    """Run a command without a shell, logging its output as it is produced
+
+    Returns the last OUTPUT_TAIL_LINES lines of combined stdout and stderr.
+    """
+    logger.info(f"Running: {command}")
+    argv = to_argv(command)
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    with subprocess.Popen(
+        argv,
+        text=True,
+        bufsize=1,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        cwd=cwd,
+        env=_merged_env(env)
+    ) as proc:
+        for line in proc.stdout:
+            line = line.rstrip()
+            logger.info(line)
+            tail.append(line)
+    
+    output = "\n".join(tail).strip()
+    if proc.returncode:
+        # Output was merged, so the tail doubles as the error text
+        raise subprocess.CalledProcessError(proc.returncode, argv, output=output, stderr=output)
+    return output
+
+def run_command_quiet(command, cwd=None, env=None):
+    """Run a command whose output isn't needed, keeping only stderr for errors"""
     logger.info(f"Running: {command}")
-    result = subprocess.run(
-        command,
-        shell=True,
+    subprocess.run(
+        to_argv(command),
         check=True,
         text=True,
-        capture_output=True,
-        cwd=cwd
-    )
-    return result.stdout.strip()
\ No newline at end of file
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        env=_merged_env(env)
+    )
\ No newline at end of file
@@ -0,0 +1,27 @@
+import threading
+import time
+
+# key -> (generation, expiry, value)
+_cache = {}
+_lock = threading.Lock()
+_generation = 0
+
+def cached_call(key, fn, ttl):
+    """Return fn(), reusing a result computed under the same key in the last ttl seconds"""
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] == _generation and now < entry[1]:
+            return entry[2]
+        generation = _generation
+
+    value = fn()
+    with _lock:
+        _cache[key] = (generation, now + ttl, value)
+    return value
+
+def invalidate():
+    """Discard all cached results, e.g. after changing cluster state"""
+    global _generation
+    with _lock:
+        _generation += 1
\ No newline at end of file
@@ -1,19 +1,23 @@
+import shlex
 import subprocess
 import tempfile
-import time
 import os
 import sys
-import yaml
+import json
 
-def run_command(command, check=True):
-    """Run a shell command and return the output"""
+REGISTRY_NAME = "kind-registry"
+REGISTRY_PORT = 5001
+NODE_READY_TIMEOUT = 300
+
+def run_command(command, check=True, input=None):
+    """Run a command without a shell and return the output"""
     try:
         result = subprocess.run(
-            command,
+            shlex.split(command),
             check=check,
             text=True,
             capture_output=True,
-            shell=True
+            input=input
         )
         return result.stdout.strip()
     except subprocess.CalledProcessError as e:
@@ -36,7 +40,7 @@ def check_prerequisites():
             sys.exit(1)
 
 def create_cluster_config():
-    """Create a multi-node cluster configuration YAML"""
+    """Create a multi-node cluster configuration file"""
     cluster_config = {
         "kind": "Cluster",
         "apiVersion": "kind.x-k8s.io/v1alpha4",
@@ -50,12 +54,18 @@ def create_cluster_config():
             {
                 "role": "worker"
             }
+        ],
+        # Let containerd read per-registry host config, see connect_registry()
+        "containerdConfigPatches": [
+            '[plugins."io.containerd.grpc.v1.cri".registry]\n'
+            '  config_path = "/etc/containerd/certs.d"'
         ]
     }
     
-    # Create a temporary file for the configuration
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.yaml', delete=False) as temp:
-        yaml.dump(cluster_config, temp, default_flow_style=False)
+    # Create a temporary file for the configuration; kind reads it as YAML,
+    # of which JSON is a subset, so the C-accelerated json module can write it
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp:
+        json.dump(cluster_config, temp, indent=2)
         return temp.name
 
 def create_cluster(config_path):
@@ -73,24 +83,53 @@ def create_cluster(config_path):
     result = run_command(f"kind create cluster --config={config_path} --name {cluster_name}")
     print(result)
 
+def create_registry():
+    """Start the local image registry the API pushes deploy images to"""
+    state = run_command(f"docker inspect -f '{{{{.State.Running}}}}' {REGISTRY_NAME}", check=False)
+    if state == "true":
+        print(f"Registry '{REGISTRY_NAME}' is already running on localhost:{REGISTRY_PORT}")
+    elif state == "false":
+        print(f"Starting existing registry '{REGISTRY_NAME}'...")
+        run_command(f"docker start {REGISTRY_NAME}")
+    else:
+        print(f"Creating registry '{REGISTRY_NAME}' on localhost:{REGISTRY_PORT}...")
+        run_command(f"docker run -d --restart=always -p 127.0.0.1:{REGISTRY_PORT}:5000 "
+                    f"--network bridge --name {REGISTRY_NAME} registry:2")
+
+def connect_registry(cluster_name="orca"):
+    """Make localhost:REGISTRY_PORT inside the cluster nodes resolve to the registry"""
+    registry_dir = f"/etc/containerd/certs.d/localhost:{REGISTRY_PORT}"
+    hosts_toml = f'[host."http://{REGISTRY_NAME}:5000"]\n'
+    
+    for node in run_command(f"kind get nodes --name {cluster_name}").split():
+        run_command(f"docker exec {node} mkdir -p {registry_dir}")
+        run_command(f"docker exec -i {node} cp /dev/stdin {registry_dir}/hosts.toml", input=hosts_toml)
+    
+    # Put the registry on the kind network so nodes can reach it by name;
+    # this fails harmlessly if it is already connected
+    run_command(f"docker network connect kind {REGISTRY_NAME}", check=False)
+
 def wait_for_nodes_ready():
     """Wait for all nodes to be in Ready state"""
     print("Waiting for nodes to be ready...")
     
-    max_attempts = 30
-    for attempt in range(max_attempts):
-        nodes_output = run_command("kubectl get nodes -o wide")
-        if nodes_output and "NotReady" not in nodes_output:
-            print("All nodes are ready!")
-            print("\nCluster node status:")
-            print(nodes_output)
-            return True
-        
-        print(f"Nodes not ready yet (attempt {attempt+1}/{max_attempts}). Waiting 10 seconds...")
-        time.sleep(10)
+    # kubectl watches the nodes and returns as soon as the last one turns Ready
+    try:
+        subprocess.run(
+            shlex.split(f"kubectl wait --for=condition=Ready nodes --all --timeout={NODE_READY_TIMEOUT}s"),
+            check=True,
+            text=True,
+            capture_output=True
+        )
+    except subprocess.CalledProcessError as e:
+        print("Timed out waiting for nodes to be ready.")
+        print(f"Error output: {e.stderr}")
+        return False
     
-    print("Timed out waiting for nodes to be ready.")
-    return False
+    print("All nodes are ready!")
+    print("\nCluster node status:")
+    print(run_command("kubectl get nodes -o wide"))
+    return True
 
 def main():
     print("Starting multi-node Kubernetes cluster setup with kind...")
@@ -103,8 +142,10 @@ def main():
     print(f"Created cluster configuration at: {config_path}")
     
     try:
-        # Create the cluster
+        # Start the local registry and create the cluster wired to it
+        create_registry()
         create_cluster(config_path)
+        connect_registry()
         
         # Wait for nodes to be ready
         if wait_for_nodes_ready():
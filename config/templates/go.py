@@ -1,17 +1,23 @@
-go_dockerfile = """FROM golang:1.18-alpine AS build
+go_dockerfile = """# syntax=docker/dockerfile:1
+FROM golang:1.18-alpine AS build
 
 WORKDIR /app
 
 COPY go.* ./
-RUN go mod download
+RUN --mount=type=cache,target=/go/pkg/mod \\
+    go mod download
 
 COPY . .
-RUN CGO_ENABLED=0 go build -o /app/server
+RUN --mount=type=cache,target=/go/pkg/mod \\
+    --mount=type=cache,target=/root/.cache/go-build \\
+    CGO_ENABLED=0 go build -o /app/server
 
 FROM alpine:3.15
 WORKDIR /app
 COPY --from=build /app/server .
-COPY .env .env
+
+# Use environment variables
+{env}
 
 EXPOSE 8080
 
@@ -1,18 +1,31 @@
-node_dockerfile = """FROM node:16-alpine
+node_dockerfile = """# syntax=docker/dockerfile:1
+FROM node:16-alpine AS build
 
 WORKDIR /app
 
 COPY package*.json ./
-RUN npm install
+RUN --mount=type=cache,target=/root/.npm \\
+    if [ -f package-lock.json ]; then npm ci; else npm install; fi
 
 COPY . .
 
 # Use environment variables
-COPY .env .env
-ENV $(cat .env | xargs)
+{env}
 
 RUN npm run build || echo "No build script found"
 
+# devDependencies are only needed for the build
+RUN npm prune --omit=dev
+
+FROM node:16-alpine
+
+WORKDIR /app
+
+COPY --from=build /app ./
+
+# Use environment variables
+{env}
+
 EXPOSE 3000
 
 CMD ["npm", "start"]
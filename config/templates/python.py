@@ -1,15 +1,26 @@
-python_dockerfile = """FROM python:3.9-slim
+python_dockerfile = """# syntax=docker/dockerfile:1
+FROM python:3.9-slim AS build
 
 WORKDIR /app
 
 COPY requirements.txt .
-RUN pip install --no-cache-dir -r requirements.txt
+# pip only creates the prefix when it installs something, and the runtime stage copies it
+RUN --mount=type=cache,target=/root/.cache/pip \\
+    mkdir -p /install && pip install --prefix=/install -r requirements.txt
 
+FROM python:3.9-slim
+
+WORKDIR /app
+
+COPY --from=build /install /usr/local
 COPY . .
 
+# Precompile bytecode so imports don't pay for it on container start; best
+# effort, since files that don't parse (e.g. Python 2 helpers) are no reason to fail
+RUN python -m compileall -q /app || true
+
 # Use environment variables
-COPY .env .env
-ENV $(cat .env)
+{env}
 
 EXPOSE 5000
 